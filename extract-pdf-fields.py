@@ -1,62 +1,171 @@
 import { serve } from "https://deno.land/std@0.168.0/http/server.ts";
+import { decodeBase64 } from "https://deno.land/std@0.224.0/encoding/base64.ts";
+import { crypto as stdCrypto } from "https://deno.land/std@0.224.0/crypto/mod.ts";
 
 const openAIApiKey = Deno.env.get('OPENAI_API_KEY');
+// Per-request/per-PDF chatter and full payload dumps only with DEBUG_PDF=1
+const DEBUG = Deno.env.get('DEBUG_PDF') === '1';
 const corsHeaders = {
   'Access-Control-Allow-Origin': '*',
   'Access-Control-Allow-Headers': 'authorization, x-client-info, apikey, content-type'
 };
+const JSON_HEADERS = Object.freeze({ ...corsHeaders, 'Content-Type': 'application/json' });
+const NDJSON_HEADERS = Object.freeze({ ...corsHeaders, 'Content-Type': 'application/x-ndjson' });
 
 // Configuration for batch processing
 const CONFIG = {
-  BATCH_SIZE: 5, // Process 5 PDFs concurrently
+  // Process 5 PDFs concurrently unless OPENAI_CONCURRENCY overrides it
+  BATCH_SIZE: Math.max(parseInt(Deno.env.get('OPENAI_CONCURRENCY') ?? '') || 5, 1),
   MAX_RETRIES: 3,
   INITIAL_DELAY: 1000, // 1 second
   MAX_DELAY: 30000, // 30 seconds
   RATE_LIMIT_DELAY: 2000, // 2 seconds between API calls
+  RATE_LIMIT_WINDOW: 10000, // Back off for 10 seconds after a 429
   MAX_FILE_SIZE: 512 * 1024 * 1024, // 512MB per file
-  MAX_FILES_PER_REQUEST: 100
+  MAX_FILES_PER_REQUEST: 100,
+  RESULT_CACHE_TTL: 60 * 60 * 1000, // Reuse extractions for 1 hour
+  RESULT_CACHE_MAX_ENTRIES: 128,
+  DECODE_YIELD_INTERVAL: 10 // ms of base64 decoding before yielding
 };
 
-// Global assistant to reuse across requests
-let globalAssistant = null;
-let assistantCreationPromise = null;
+// Static OpenAI request headers, shared by every call
+const OPENAI_HEADERS_JSON = Object.freeze({
+  'Authorization': `Bearer ${openAIApiKey}`,
+  'Content-Type': 'application/json',
+  'OpenAI-Beta': 'assistants=v2'
+});
+const OPENAI_HEADERS_NOBODY = Object.freeze({
+  'Authorization': `Bearer ${openAIApiKey}`,
+  'OpenAI-Beta': 'assistants=v2'
+});
+
+// Assistant instructions; __FIELDS__ is replaced with the JSON field list
+const ASSISTANT_INSTRUCTIONS = `Extract invoice data as JSON array. Each object = one line item.
+
+Required fields: __FIELDS__
+
+Rules:
+- Use exact field names provided
+- Missing values: "" for strings, 0 for numbers  
+- Include document-level data in each line item
+- Return only JSON array, no explanations
+
+Format:
+[{"field1":"value1","field2":"value2"}]`;
+
+// Native base64 decoding (Uint8Array.fromBase64) where the runtime has it;
+// std's decodeBase64 goes through atob plus a per-byte loop
+const HAS_NATIVE_BASE64 = typeof Uint8Array.fromBase64 === 'function';
+const BASE64_WHITESPACE_RE = /[\t\n\f\r ]/;
+const BASE64_WHITESPACE_ALL_RE = /[\t\n\f\r ]+/g;
+
+// Shared pooled client so concurrent OpenAI calls reuse (and multiplex over)
+// warm connections instead of handshaking per request. Not every runtime
+// exposes Deno.createHttpClient; fall back to the default fetch client there.
+const openaiClient = Deno.createHttpClient?.({
+  poolMaxIdlePerHost: 32,
+  poolIdleTimeout: 90_000,
+  http2: true
+});
+
+// Pre-warm TLS/HTTP2 to OpenAI while the isolate boots so the first real
+// request doesn't pay the handshake
+if (openAIApiKey) {
+  fetch('https://api.openai.com/v1/models', {
+    method: 'HEAD',
+    client: openaiClient,
+    headers: OPENAI_HEADERS_NOBODY
+  }).then(res => res.body?.cancel()).catch(() => {});
+}
+
+// Counting semaphore; pause() holds back new acquirers until a deadline
+class Semaphore {
+  constructor(permits) {
+    this.permits = permits;
+    this.waiters = [];
+    this.resumeAt = 0;
+  }
+
+  async acquire() {
+    if (this.permits > 0) {
+      this.permits--;
+    } else {
+      await new Promise(resolve => this.waiters.push(resolve));
+    }
+    const waitMs = this.resumeAt - Date.now();
+    if (waitMs > 0) await delay(waitMs);
+  }
+
+  release() {
+    const next = this.waiters.shift();
+    if (next) next();
+    else this.permits++;
+  }
+
+  pause(ms) {
+    this.resumeAt = Math.max(this.resumeAt, Date.now() + ms);
+  }
+}
+
+// Shared across requests: caps in-flight PDF extractions per isolate and is
+// paused by fetchWithRetry whenever OpenAI answers 429
+const openaiSlots = new Semaphore(CONFIG.BATCH_SIZE);
+
+// Timestamp of the most recent 429 from OpenAI
+let last429At = 0;
+
+// Assistants to reuse across requests, keyed by JSON.stringify(fieldNames)
+// since the instructions depend on the field list. The promise itself is
+// cached so concurrent first requests share a single creation.
+const assistantPromises = new Map();
+
+// Deno KV handle used to persist assistant IDs across isolates
+let kvPromise = null;
+
+// Recent extractions keyed by sha256(PDF base64) + field list, so resubmitted
+// PDFs skip the upload and run. Map order doubles as LRU order.
+const resultCache = new Map();
 
 serve(async (req) => {
   // Handle CORS preflight requests
   if (req.method === 'OPTIONS') {
-    console.log("Handling OPTIONS request");
+    debugLog("Handling OPTIONS request");
     return new Response(null, { headers: corsHeaders });
   }
 
   try {
-    const requestBody = await parseRequestBody(req);
-    const { pdfs, fieldNames, selectedArea } = validateAndNormalizeRequest(requestBody);
+    // The parsed body is not kept: validateAndNormalizeRequest moves every
+    // base64 string out of it, so each can be freed once it's uploaded
+    const { pdfs, fieldNames, selectedArea } = validateAndNormalizeRequest(await parseRequestBody(req));
     
-    console.log(`🚀 Processing ${pdfs.length} PDFs with batch processing`);
+    console.log(`🚀 Processing ${pdfs.names.length} PDFs with up to ${CONFIG.BATCH_SIZE} in flight`);
     
-    // Initialize or reuse global assistant
-    if (!globalAssistant && openAIApiKey) {
-      globalAssistant = await getOrCreateAssistant(fieldNames);
+    // Initialize or reuse global assistant. Not awaited here: each PDF only
+    // needs it after its upload, so creation overlaps with the first uploads.
+    // Failures surface per PDF, and the signal makes PDFs still uploading or
+    // not yet started give up as soon as creation fails.
+    const assistantAbort = new AbortController();
+    const assistant = openAIApiKey && {
+      promise: getOrCreateAssistant(fieldNames),
+      signal: assistantAbort.signal
+    };
+    assistant?.promise.catch(error => assistantAbort.abort(error));
+
+    // Clients that ask for NDJSON get each result as soon as its PDF finishes
+    if (req.headers.get('accept')?.includes('application/x-ndjson')) {
+      return new Response(streamResultsNdjson(pdfs, fieldNames, selectedArea, assistant), {
+        headers: NDJSON_HEADERS
+      });
     }
 
-    // Process PDFs in batches
-    const results = await processPDFsInBatches(pdfs, fieldNames, selectedArea);
-    
-    const response = {
-      results,
-      totalProcessed: pdfs.length,
-      successCount: results.filter(r => r.success).length,
-      isUsingMockData: results.some(r => r.isUsingMockData),
-      batchInfo: {
-        batchSize: CONFIG.BATCH_SIZE,
-        totalBatches: Math.ceil(pdfs.length / CONFIG.BATCH_SIZE)
-      }
-    };
+    // Process PDFs through a bounded worker pool
+    const results = await processPDFs(pdfs, fieldNames, selectedArea, assistant);
+    const summary = summarizeResults(results);
 
-    console.log(`✅ Completed processing: ${response.successCount}/${response.totalProcessed} successful`);
+    console.log(`✅ Completed processing: ${summary.successCount}/${summary.totalProcessed} successful`);
     
-    return new Response(JSON.stringify(response), {
-      headers: { ...corsHeaders, 'Content-Type': 'application/json' }
+    return new Response(streamResultsJson(results, summary), {
+      headers: JSON_HEADERS
     });
 
   } catch (error) {
@@ -66,20 +175,90 @@ serve(async (req) => {
       isUsingMockData: true,
       results: []
     }), {
-      headers: { ...corsHeaders, 'Content-Type': 'application/json' },
+      headers: JSON_HEADERS,
       status: 400
     });
   }
 });
 
+// Serializes { results, ...summary } one result at a time, so the full
+// response string is never held in memory at once
+function streamResultsJson(results, summary) {
+  const encoder = new TextEncoder();
+  let index = 0;
+
+  return new ReadableStream({
+    start(controller) {
+      controller.enqueue(encoder.encode('{"results":['));
+    },
+    pull(controller) {
+      if (index < results.length) {
+        const prefix = index > 0 ? ',' : '';
+        controller.enqueue(encoder.encode(prefix + JSON.stringify(results[index++])));
+        return;
+      }
+      // Summary fields follow the array: '],' + the object minus its '{'
+      controller.enqueue(encoder.encode('],' + JSON.stringify(summary).slice(1)));
+      controller.close();
+    }
+  });
+}
+
+// NDJSON variant: one {"type":"result"} line per PDF in completion order
+// (tagged with its input index), then a {"type":"summary"} line
+function streamResultsNdjson(pdfs, fieldNames, selectedArea, assistant) {
+  const encoder = new TextEncoder();
+  const { readable, writable } = new TransformStream();
+  const writer = writable.getWriter();
+  // A client that disconnects mid-stream shouldn't abort the remaining PDFs
+  const writeLine = value =>
+    writer.write(encoder.encode(JSON.stringify(value) + '\n')).catch(() => {});
+
+  (async () => {
+    try {
+      const results = await processPDFs(pdfs, fieldNames, selectedArea, assistant,
+        (result, index) => writeLine({ type: 'result', index, result }));
+      const summary = summarizeResults(results);
+      console.log(`✅ Completed processing: ${summary.successCount}/${summary.totalProcessed} successful`);
+      await writeLine({ type: 'summary', ...summary });
+    } catch (error) {
+      console.error('❌ Error processing request:', error);
+      await writeLine({ type: 'error', error: error.message });
+    } finally {
+      await writer.close().catch(() => {});
+    }
+  })();
+
+  return readable;
+}
+
+function summarizeResults(results) {
+  let successCount = 0;
+  let mockCount = 0;
+  for (const result of results) {
+    if (result.success) successCount++;
+    if (result.isUsingMockData) mockCount++;
+  }
+
+  return {
+    totalProcessed: results.length,
+    successCount,
+    isUsingMockData: mockCount > 0,
+    batchInfo: {
+      batchSize: CONFIG.BATCH_SIZE,
+      totalBatches: Math.ceil(results.length / CONFIG.BATCH_SIZE)
+    }
+  };
+}
+
 async function parseRequestBody(req) {
+  // Read the body once; cloning would tee the whole base64 payload in memory
+  const textBody = await req.text();
   try {
-    const reqClone = req.clone();
-    const requestBody = await reqClone.json();
-    console.log("✅ Request body parsed successfully");
+    const requestBody = JSON.parse(textBody);
+    debugLog("✅ Request body parsed successfully");
     return requestBody;
   } catch (jsonError) {
-    const textBody = await req.clone().text();
     console.log("Raw request body (first 500 chars):", textBody.substring(0, 500));
     throw new Error(`Invalid JSON in request body: ${jsonError.message}`);
   }
@@ -102,200 +281,400 @@ function validateAndNormalizeRequest(requestBody) {
     throw new Error(`Too many files. Maximum ${CONFIG.MAX_FILES_PER_REQUEST} files allowed per request.`);
   }
 
-  // Normalize PDF structure
-  const normalizedPdfs = pdfs.map((pdf, index) => {
+  // Normalize into parallel arrays so the (large) base64 bodies can be
+  // released one by one without touching the per-PDF metadata
+  const count = pdfs.length;
+  const names = new Array(count);
+  const bodies = new Array(count);
+  const rejections = new Array(count); // error message if refused up front
+  let stringCount = 0;
+  let objectCount = 0;
+  let nullDataCount = 0;
+
+  for (let index = 0; index < count; index++) {
+    const pdf = pdfs[index];
+    pdfs[index] = null; // bodies[] becomes the only reference to the payload
+    let name = `document-${index + 1}.pdf`;
+    let pdfBase64 = null;
+
     if (typeof pdf === 'string') {
-      return {
-        name: `document-${index + 1}.pdf`,
-        pdfBase64: pdf
-      };
-    } else if (typeof pdf === 'object') {
-      const pdfBase64 = pdf.pdfBase64 || pdf.base64 || pdf.data || null;
-      const name = pdf.name || pdf.filename || `document-${index + 1}.pdf`;
-      
-      // Validate file size
-      if (pdfBase64) {
-        const sizeBytes = Math.ceil(pdfBase64.length * 0.75); // Approximate decoded size
+      stringCount++;
+      pdfBase64 = pdf;
+    } else if (pdf && typeof pdf === 'object') {
+      objectCount++;
+      pdfBase64 = pdf.pdfBase64 || pdf.base64 || pdf.data || null;
+      name = pdf.name || pdf.filename || name;
+    }
+    if (!pdfBase64) nullDataCount++;
+
+    // Reject malformed and oversized files here, before anything tries to
+    // decode or upload them
+    let rejection = null;
+    if (pdfBase64) {
+      if (!isLikelyBase64Pdf(pdfBase64)) {
+        console.warn(`PDF ${name} is not base64-encoded PDF data`);
+        rejection = 'Invalid base64 or not a PDF';
+      } else {
+        const sizeBytes = base64DecodedSize(pdfBase64);
         if (sizeBytes > CONFIG.MAX_FILE_SIZE) {
           console.warn(`PDF ${name} exceeds size limit: ${sizeBytes} bytes`);
+          rejection = `File too large. Maximum ${CONFIG.MAX_FILE_SIZE} bytes allowed per file.`;
         }
       }
-      
-      return { name, pdfBase64 };
+      if (rejection) pdfBase64 = null;
     }
-    return {
-      name: `document-${index + 1}.pdf`,
-      pdfBase64: null
-    };
-  });
 
-  console.log(`📋 Normalized ${normalizedPdfs.length} PDFs for processing`);
-  return { pdfs: normalizedPdfs, fieldNames, selectedArea };
+    names[index] = name;
+    bodies[index] = pdfBase64;
+    rejections[index] = rejection;
+  }
+
+  debugLog('📋 Normalized PDFs:', { count, stringCount, objectCount, nullDataCount });
+  return { pdfs: { names, bodies, rejections }, fieldNames, selectedArea };
 }
 
-async function processPDFsInBatches(pdfs, fieldNames, selectedArea) {
-  const allResults = [];
-  const totalBatches = Math.ceil(pdfs.length / CONFIG.BATCH_SIZE);
-  
-  for (let batchIndex = 0; batchIndex < totalBatches; batchIndex++) {
-    const startIndex = batchIndex * CONFIG.BATCH_SIZE;
-    const endIndex = Math.min(startIndex + CONFIG.BATCH_SIZE, pdfs.length);
-    const batch = pdfs.slice(startIndex, endIndex);
-    
-    console.log(`📦 Processing batch ${batchIndex + 1}/${totalBatches} (${batch.length} PDFs)`);
-    
-    try {
-      const batchResults = await processBatch(batch, fieldNames, selectedArea, batchIndex);
-      allResults.push(...batchResults);
-      
-      // Add delay between batches to respect rate limits
-      if (batchIndex < totalBatches - 1) {
-        await delay(CONFIG.RATE_LIMIT_DELAY);
-      }
-      
-    } catch (batchError) {
-      console.error(`❌ Batch ${batchIndex + 1} failed:`, batchError);
-      
-      // Generate mock data for failed batch
-      const mockResults = batch.map(pdf => ({
-        name: pdf.name,
-        success: false,
-        error: `Batch processing failed: ${batchError.message}`,
-        extractedFields: getMockFields({ fieldNames, selectedArea, pdfName: pdf.name }),
-        isUsingMockData: true
-      }));
-      
-      allResults.push(...mockResults);
+// Cheap sanity check: base64 of the "%PDF-" header always starts "JVBER"
+function isLikelyBase64Pdf(s) {
+  return typeof s === 'string' && s.length >= 100 && s.startsWith('JVBER');
+}
+
+// Exact decoded length of a base64 string, without decoding it. ASCII
+// whitespace (e.g. line wrapping) carries no data and is not counted.
+function base64DecodedSize(base64Str) {
+  let end = base64Str.length;
+  let chars = end;
+  if (BASE64_WHITESPACE_RE.test(base64Str)) {
+    for (let i = 0; i < base64Str.length; i++) {
+      if (isBase64Whitespace(base64Str.charCodeAt(i))) chars--;
     }
+    while (end > 0 && isBase64Whitespace(base64Str.charCodeAt(end - 1))) end--;
   }
-  
-  return allResults;
+  const padding = base64Str[end - 1] !== '=' ? 0 : base64Str[end - 2] === '=' ? 2 : 1;
+  return Math.floor(chars * 3 / 4) - padding;
 }
 
-async function processBatch(batch, fieldNames, selectedArea, batchIndex) {
-  if (!openAIApiKey) {
-    console.log(`⚠️ No OpenAI API key, using mock data for batch ${batchIndex + 1}`);
-    return batch.map(pdf => ({
-      name: pdf.name,
-      success: true,
-      extractedFields: getMockFields({ fieldNames, selectedArea, pdfName: pdf.name }),
-      isUsingMockData: true
-    }));
-  }
+// Tab, LF, FF, CR and space: the whitespace atob/fromBase64 skip over
+function isBase64Whitespace(code) {
+  return code === 32 || code === 9 || code === 10 || code === 12 || code === 13;
+}
 
-  // Process PDFs in the batch with controlled concurrency
-  const batchPromises = batch.map(async (pdf, index) => {
-    // Stagger API calls within the batch
-    await delay(index * 500);
-    
-    if (!pdf.pdfBase64) {
-      return {
-        name: pdf.name,
-        success: false,
-        error: "No PDF data provided for this file",
-        isUsingMockData: true,
-        extractedFields: {}
+// assistant is { promise, signal } (signal aborts once creation has failed);
+// onResult(result, index), if given, is called as each PDF finishes
+async function processPDFs(pdfs, fieldNames, selectedArea, assistant, onResult) {
+  if (!openAIApiKey) {
+    console.log(`⚠️ No OpenAI API key, using mock data for ${pdfs.names.length} PDFs`);
+    return pdfs.names.map((name, index) => {
+      const result = {
+        name,
+        success: true,
+        extractedFields: getMockFields({ fieldNames, selectedArea, pdfName: name }),
+        isUsingMockData: true
       };
-    }
+      onResult?.(result, index);
+      return result;
+    });
+  }
 
+  // Sliding window of BATCH_SIZE: the next PDF starts as soon as any in-flight
+  // one finishes, so a slow PDF never holds up a whole batch
+  return await runPool(pdfs.names, CONFIG.BATCH_SIZE, async (name, index) => {
     try {
-      const extractedFields = await extractDataWithRetry(pdf, fieldNames);
-      return {
-        name: pdf.name,
-        success: true,
-        extractedFields,
-        isUsingMockData: false
-      };
+      return await processOne(pdfs, index, fieldNames, selectedArea, assistant);
     } catch (error) {
-      console.error(`❌ Failed to process ${pdf.name}:`, error);
+      // processOne reports its own failures; this only catches what slips
+      // past it, so one PDF can never discard the others' finished work
+      console.error(`❌ Unexpected failure for ${name}:`, error);
       return {
-        name: pdf.name,
+        name,
         success: false,
-        error: error.message,
-        extractedFields: getMockFields({ fieldNames, selectedArea, pdfName: pdf.name }),
+        error: String(error?.message ?? error),
+        extractedFields: getMockFields({ fieldNames, selectedArea, pdfName: name }),
         isUsingMockData: true
       };
     }
+  }, onResult);
+}
+
+// Runs worker over items with at most `concurrency` in flight; results keep
+// the input order, and onResult sees each one as it completes
+async function runPool(items, concurrency, worker, onResult) {
+  const results = new Array(items.length);
+  const entries = items.entries();
+  const runners = Array.from({ length: Math.min(concurrency, items.length) }, async () => {
+    for (const [index, item] of entries) {
+      results[index] = await worker(item, index);
+      onResult?.(results[index], index);
+    }
   });
+  await Promise.all(runners);
+  return results;
+}
+
+async function processOne(pdfs, index, fieldNames, selectedArea, assistant) {
+  const name = pdfs.names[index];
+
+  if (pdfs.rejections[index]) {
+    return {
+      name,
+      success: false,
+      error: pdfs.rejections[index],
+      isUsingMockData: true,
+      extractedFields: {}
+    };
+  }
+
+  // Take the payload out of the shared array; from here on only this
+  // extraction holds it, and uploadFile drops it once the upload is done
+  const bodyRef = { s: pdfs.bodies[index] };
+  pdfs.bodies[index] = null;
+
+  if (!bodyRef.s) {
+    return {
+      name,
+      success: false,
+      error: "No PDF data provided for this file",
+      isUsingMockData: true,
+      extractedFields: {}
+    };
+  }
+
+  try {
+    const cacheKey = await resultCacheKey(bodyRef.s, fieldNames);
+    let lineItems = getCachedResult(cacheKey);
+
+    if (lineItems) {
+      debugLog(`♻️ Reusing cached extraction for ${name}`);
+    } else {
+      // Only back off if OpenAI recently rate limited us, and only for PDFs
+      // that are about to call it
+      if (Date.now() - last429At < CONFIG.RATE_LIMIT_WINDOW) {
+        await delay(CONFIG.RATE_LIMIT_DELAY);
+      }
+      await openaiSlots.acquire();
+      try {
+        lineItems = await extractDataWithRetry(name, bodyRef, assistant);
+      } finally {
+        openaiSlots.release();
+      }
+      setCachedResult(cacheKey, lineItems);
+    }
+
+    // Filenames follow this request's name, not whoever filled the cache
+    const baseName = name.endsWith('.pdf') ? name.slice(0, -4) : name;
+    return {
+      name,
+      success: true,
+      extractedFields: lineItems.map((item, index) => ({
+        filename: `${baseName}_${index + 1}.json`,
+        data: item
+      })),
+      isUsingMockData: false
+    };
+  } catch (error) {
+    console.error(`❌ Failed to process ${name}:`, error);
+    return {
+      name,
+      success: false,
+      error: error.message,
+      extractedFields: getMockFields({ fieldNames, selectedArea, pdfName: name }),
+      isUsingMockData: true
+    };
+  }
+}
 
-  return await Promise.all(batchPromises);
+// Hashes the base64 text as sent, slice by slice: no decode, and no full
+// byte copy of the payload (std digest accepts an async iterable)
+async function resultCacheKey(pdfBase64, fieldNames) {
+  const digest = await stdCrypto.subtle.digest('SHA-256', textSliceStream(pdfBase64));
+  return `${toHex(digest)}:${JSON.stringify(fieldNames)}`;
+}
+
+// Yields the UTF-8 bytes of str in fixed-size slices, handing the event
+// loop back every few ms like base64DecodeStream
+async function* textSliceStream(str, chunkChars = 262144) {
+  const encoder = new TextEncoder();
+  let lastYield = performance.now();
+  for (let i = 0; i < str.length; i += chunkChars) {
+    yield encoder.encode(str.slice(i, i + chunkChars));
+
+    if (performance.now() - lastYield > CONFIG.DECODE_YIELD_INTERVAL) {
+      await delay(0);
+      lastYield = performance.now();
+    }
+  }
 }
 
-async function extractDataWithRetry(pdf, fieldNames) {
+function getCachedResult(key) {
+  const entry = resultCache.get(key);
+  if (!entry) return null;
+
+  resultCache.delete(key);
+  if (Date.now() - entry.ts > CONFIG.RESULT_CACHE_TTL) return null;
+  resultCache.set(key, entry); // Most recently used goes last
+  return entry.lineItems;
+}
+
+function setCachedResult(key, lineItems) {
+  resultCache.delete(key);
+  resultCache.set(key, { lineItems, ts: Date.now() });
+  if (resultCache.size > CONFIG.RESULT_CACHE_MAX_ENTRIES) {
+    resultCache.delete(resultCache.keys().next().value);
+  }
+}
+
+async function extractDataWithRetry(name, bodyRef, { promise, signal }) {
+  // No point uploading for an assistant that already failed to materialize
+  signal.throwIfAborted();
+
+  // Upload once (fetchWithRetry already retries the request itself) and only
+  // retry the assistant run, so the payload can be released after upload.
+  // The assistant lookup runs alongside the upload, which is aborted if the
+  // lookup fails first.
+  const [upload, assistant] = await Promise.allSettled([
+    uploadFile(bodyRef, name, signal),
+    promise
+  ]);
+  if (assistant.status === 'rejected') {
+    if (upload.status === 'fulfilled') runInBackground(cleanupResources(upload.value));
+    throw assistant.reason;
+  }
+  if (upload.status === 'rejected') throw upload.reason;
+  const fileId = upload.value;
+  const assistantId = assistant.value.id;
   let lastError;
+
+  try {
+    for (let attempt = 0; attempt < CONFIG.MAX_RETRIES; attempt++) {
+      try {
+        if (attempt > 0) {
+          const delayMs = Math.min(
+            CONFIG.INITIAL_DELAY * Math.pow(2, attempt - 1),
+            CONFIG.MAX_DELAY
+          );
+          debugLog(`🔄 Retry attempt ${attempt + 1} for ${name} after ${delayMs}ms`);
+          await delay(delayMs);
+        }
+        
+        return await extractDataWithAssistant(assistantId, fileId, name);
+      } catch (error) {
+        lastError = error;
+
+        // The cached assistant was deleted upstream; drop it so the next
+        // request creates a fresh one instead of failing the same way
+        if (error.assistantMissing) {
+          runInBackground(forgetAssistant(assistant.value));
+          throw error;
+        }
+        
+        // Don't retry on certain errors
+        if (error.message.includes('file too large') || 
+            error.message.includes('invalid file format')) {
+          throw error;
+        }
+        
+        console.warn(`⚠️ Attempt ${attempt + 1} failed for ${name}: ${error.message}`);
+      }
+    }
+  } finally {
+    // Cleanup resources off the critical path; the result doesn't depend on it
+    runInBackground(cleanupResources(fileId));
+  }
   
-  for (let attempt = 0; attempt < CONFIG.MAX_RETRIES; attempt++) {
+  throw lastError;
+}
+
+function getOrCreateAssistant(fieldNames) {
+  // Serialized once; doubles as the cache key and the instructions' field list
+  const fieldsJson = JSON.stringify(fieldNames);
+  let assistantPromise = assistantPromises.get(fieldsJson);
+
+  if (!assistantPromise) {
+    // Forget a failed creation so the next request can try again
+    assistantPromise = loadOrCreateAssistant(fieldsJson).catch(error => {
+      assistantPromises.delete(fieldsJson);
+      throw error;
+    });
+    assistantPromises.set(fieldsJson, assistantPromise);
+  }
+  return assistantPromise;
+}
+
+// Looks up an assistant created from the same creation body by a previous
+// isolate before paying for a new one. Keying on the whole body means an
+// instructions, model or tool change gets a new assistant. Deno KV is
+// optional; without it we always create.
+async function loadOrCreateAssistant(fieldsJson) {
+  const kv = await getKv();
+  const body = JSON.stringify(assistantCreationBody(fieldsJson));
+  const kvKey = kv && ['assistant', await sha256Hex(body)];
+
+  if (kv) {
     try {
-      if (attempt > 0) {
-        const delayMs = Math.min(
-          CONFIG.INITIAL_DELAY * Math.pow(2, attempt - 1),
-          CONFIG.MAX_DELAY
-        );
-        console.log(`🔄 Retry attempt ${attempt + 1} for ${pdf.name} after ${delayMs}ms`);
-        await delay(delayMs);
+      const cached = await kv.get(kvKey);
+      if (cached.value) {
+        debugLog(`♻️ Reusing cached assistant: ${cached.value}`);
+        return { id: cached.value, fieldsJson, kvKey };
       }
-      
-      return await extractDataWithAssistant(pdf, fieldNames);
     } catch (error) {
-      lastError = error;
-      
-      // Don't retry on certain errors
-      if (error.message.includes('file too large') || 
-          error.message.includes('invalid file format')) {
-        throw error;
-      }
-      
-      console.warn(`⚠️ Attempt ${attempt + 1} failed for ${pdf.name}: ${error.message}`);
+      console.warn(`Assistant cache lookup failed: ${error.message}`);
     }
   }
-  
-  throw lastError;
+
+  const { id } = await createOptimizedAssistant(body);
+  if (kv) {
+    await kv.set(kvKey, id)
+      .catch(error => console.warn(`Assistant cache write failed: ${error.message}`));
+  }
+  return { id, fieldsJson, kvKey };
 }
 
-async function getOrCreateAssistant(fieldNames) {
-  // Prevent multiple assistant creation attempts
-  if (assistantCreationPromise) {
-    return await assistantCreationPromise;
+// Drops a stale assistant from both caches, unless another request has
+// already replaced it with a newer one
+async function forgetAssistant({ id, fieldsJson, kvKey }) {
+  const current = assistantPromises.get(fieldsJson);
+  if (current && (await current.catch(() => null))?.id === id) {
+    assistantPromises.delete(fieldsJson);
   }
 
-  assistantCreationPromise = createOptimizedAssistant(fieldNames);
-  try {
-    const assistant = await assistantCreationPromise;
-    assistantCreationPromise = null;
-    return assistant;
-  } catch (error) {
-    assistantCreationPromise = null;
-    throw error;
+  const kv = kvKey && await getKv();
+  if (kv) {
+    const entry = await kv.get(kvKey);
+    if (entry.value === id) await kv.atomic().check(entry).delete(kvKey).commit();
   }
+  console.warn(`Assistant ${id} no longer exists; it will be recreated`);
 }
 
-async function createOptimizedAssistant(fieldNames) {
-  const instructions = `Extract invoice data as JSON array. Each object = one line item.
+function getKv() {
+  kvPromise ??= Promise.resolve(Deno.openKv?.() ?? null).catch(error => {
+    console.warn(`Deno KV unavailable: ${error.message}`);
+    return null;
+  });
+  return kvPromise;
+}
 
-Required fields: ${JSON.stringify(fieldNames)}
+async function sha256Hex(text) {
+  return toHex(await crypto.subtle.digest('SHA-256', new TextEncoder().encode(text)));
+}
 
-Rules:
-- Use exact field names provided
-- Missing values: "" for strings, 0 for numbers  
-- Include document-level data in each line item
-- Return only JSON array, no explanations
+function toHex(buffer) {
+  return Array.from(new Uint8Array(buffer), b => b.toString(16).padStart(2, '0')).join('');
+}
 
-Format:
-[{"field1":"value1","field2":"value2"}]`;
+function assistantCreationBody(fieldsJson) {
+  return {
+    name: "Batch Invoice Extractor",
+    // Function replacer so `$` sequences in field names are taken literally
+    instructions: ASSISTANT_INSTRUCTIONS.replace('__FIELDS__', () => fieldsJson),
+    model: "gpt-4o-mini", // More cost-effective for batch processing
+    tools: [{ type: "file_search" }]
+  };
+}
 
+async function createOptimizedAssistant(body) {
   const response = await fetchWithRetry('https://api.openai.com/v1/assistants', {
     method: 'POST',
-    headers: {
-      'Authorization': `Bearer ${openAIApiKey}`,
-      'Content-Type': 'application/json',
-      'OpenAI-Beta': 'assistants=v2'
-    },
-    body: JSON.stringify({
-      name: "Batch Invoice Extractor",
-      instructions,
-      model: "gpt-4o-mini", // More cost-effective for batch processing
-      tools: [{ type: "file_search" }]
-    })
+    headers: OPENAI_HEADERS_JSON,
+    body
   });
 
   const data = await response.json();
@@ -305,118 +684,144 @@ Format:
   return data;
 }
 
-async function extractDataWithAssistant(pdf, fieldNames) {
-  const pdfBuffer = Uint8Array.from(atob(pdf.pdfBase64), c => c.charCodeAt(0));
-  let fileId = null;
-  let threadId = null;
-
-  try {
-    // Upload file
-    fileId = await uploadFile(pdfBuffer, pdf.name);
-    
-    // Create thread
-    threadId = await createThread();
-    
-    // Process with assistant
-    const result = await processWithAssistant(threadId, fileId, pdf.name);
-    
-    return result.map((item, index) => ({
-      filename: pdf.name.replace(/\.pdf$/, `_${index + 1}.json`),
-      data: item
-    }));
-
-  } finally {
-    // Cleanup resources
-    await cleanupResources(fileId, threadId);
-  }
+// Returns the parsed line items; callers attach per-request filenames
+async function extractDataWithAssistant(assistantId, fileId, name) {
+  // Process with assistant, with the file attached to the first message
+  return processWithAssistant(assistantId, {
+    role: "user",
+    content: `Extract data from: ${name}`,
+    attachments: [{
+      file_id: fileId,
+      tools: [{ type: "file_search" }]
+    }]
+  });
 }
 
-async function uploadFile(pdfBuffer, fileName) {
-  const formData = new FormData();
-  const blob = new Blob([pdfBuffer], { type: 'application/pdf' });
-  formData.append('file', blob, fileName);
-  formData.append('purpose', 'assistants');
-
-  const response = await fetchWithRetry('https://api.openai.com/v1/files', {
-    method: 'POST',
-    headers: {
-      'Authorization': `Bearer ${openAIApiKey}`,
-      'OpenAI-Beta': 'assistants=v2'
-    },
-    body: formData
+// Streams bodyRef.s to the files endpoint (decoded on the fly, never
+// materialized in full) and then drops it. signal cancels the upload.
+async function uploadFile(bodyRef, fileName, signal) {
+  // A streamed body can only be read once, so build a fresh one per attempt
+  const response = await fetchWithRetry('https://api.openai.com/v1/files', () => {
+    const { body, contentType } = createMultipartUpload(bodyRef.s, fileName);
+    return {
+      method: 'POST',
+      headers: { ...OPENAI_HEADERS_NOBODY, 'Content-Type': contentType },
+      body,
+      duplex: 'half',
+      signal
+    };
   });
 
   const data = await response.json();
+  // Uploaded or rejected either way; let the string be collected while
+  // sibling PDFs are still running
+  bodyRef.s = null;
   if (data.error) throw new Error(`File upload failed: ${data.error.message}`);
   
   return data.id;
 }
 
-async function createThread() {
-  const response = await fetchWithRetry('https://api.openai.com/v1/threads', {
-    method: 'POST',
-    headers: {
-      'Authorization': `Bearer ${openAIApiKey}`,
-      'Content-Type': 'application/json',
-      'OpenAI-Beta': 'assistants=v2'
+// Streams a multipart/form-data body for the files endpoint, decoding the
+// base64 payload chunk by chunk as the request is sent
+function createMultipartUpload(pdfBase64, fileName) {
+  const boundary = `----pdf-extract-${crypto.randomUUID()}`;
+  const safeName = fileName.replace(/["\r\n]/g, '_');
+  const encoder = new TextEncoder();
+  const head = encoder.encode(
+    `--${boundary}\r\n` +
+    `Content-Disposition: form-data; name="purpose"\r\n\r\n` +
+    `assistants\r\n` +
+    `--${boundary}\r\n` +
+    `Content-Disposition: form-data; name="file"; filename="${safeName}"\r\n` +
+    `Content-Type: application/pdf\r\n\r\n`
+  );
+  const tail = encoder.encode(`\r\n--${boundary}--\r\n`);
+  const chunks = base64DecodeStream(pdfBase64);
+
+  const body = new ReadableStream({
+    start(controller) {
+      controller.enqueue(head);
     },
-    body: JSON.stringify({})
+    async pull(controller) {
+      const { value, done } = await chunks.next();
+      if (done) {
+        controller.enqueue(tail);
+        controller.close();
+      } else {
+        controller.enqueue(value);
+      }
+    },
+    cancel() {
+      chunks.return();
+    }
   });
 
-  const data = await response.json();
-  if (data.error) throw new Error(`Thread creation failed: ${data.error.message}`);
-  
-  return data.id;
+  return { body, contentType: `multipart/form-data; boundary=${boundary}` };
 }
 
-async function processWithAssistant(threadId, fileId, fileName) {
-  // Send message
-  await fetchWithRetry(`https://api.openai.com/v1/threads/${threadId}/messages`, {
-    method: 'POST',
-    headers: {
-      'Authorization': `Bearer ${openAIApiKey}`,
-      'Content-Type': 'application/json',
-      'OpenAI-Beta': 'assistants=v2'
-    },
-    body: JSON.stringify({
-      role: "user",
-      content: `Extract data from: ${fileName}`,
-      attachments: [{
-        file_id: fileId,
-        tools: [{ type: "file_search" }]
-      }]
-    })
-  });
+// Yields decoded bytes. Whitespace (line-wrapped base64) is stripped per
+// slice and any tail that isn't a multiple of 4 real base64 characters is
+// carried into the next slice, so each decode sees whole 4-char groups.
+// A fast consumer can pull chunks back to back, so hand the event loop back
+// every few ms of decoding.
+async function* base64DecodeStream(base64Str, chunkChars = 262144) {
+  let carry = '';
+  let lastYield = performance.now();
+  for (let i = 0; i < base64Str.length; i += chunkChars) {
+    let chunk = carry + base64Str.slice(i, i + chunkChars);
+    if (BASE64_WHITESPACE_RE.test(chunk)) chunk = chunk.replace(BASE64_WHITESPACE_ALL_RE, '');
+
+    const usable = chunk.length - (chunk.length % 4);
+    carry = chunk.slice(usable);
+    if (usable > 0) yield decodeBase64Chunk(chunk.slice(0, usable));
+
+    if (performance.now() - lastYield > CONFIG.DECODE_YIELD_INTERVAL) {
+      await delay(0);
+      lastYield = performance.now();
+    }
+  }
+  // Unpadded input can end in a partial group; both decoders accept that
+  if (carry) yield decodeBase64Chunk(carry);
+}
+
+function decodeBase64Chunk(chunk) {
+  return HAS_NATIVE_BASE64 ? Uint8Array.fromBase64(chunk) : decodeBase64(chunk);
+}
 
-  // Run assistant
-  const runResponse = await fetchWithRetry(`https://api.openai.com/v1/threads/${threadId}/runs`, {
+async function processWithAssistant(assistantId, firstMessage) {
+  // Create the thread, post the message and start the run in one request
+  const runResponse = await fetchWithRetry('https://api.openai.com/v1/threads/runs', {
     method: 'POST',
-    headers: {
-      'Authorization': `Bearer ${openAIApiKey}`,
-      'Content-Type': 'application/json',
-      'OpenAI-Beta': 'assistants=v2'
-    },
+    headers: OPENAI_HEADERS_JSON,
     body: JSON.stringify({
-      assistant_id: globalAssistant.id
+      assistant_id: assistantId,
+      thread: { messages: [firstMessage] }
     })
   });
 
   const runData = await runResponse.json();
-  if (runData.error) throw new Error(`Run creation failed: ${runData.error.message}`);
+  if (runData.error) {
+    const error = new Error(`Run creation failed: ${runData.error.message}`);
+    // e.g. "No assistant found with id 'asst_…'"
+    error.assistantMissing = runResponse.status === 404 && /assistant/i.test(runData.error.message);
+    throw error;
+  }
 
   // Poll for completion with timeout
   const runId = runData.id;
+  const threadId = runData.thread_id;
   const maxWaitTime = 300000; // 5 minutes
-  const pollInterval = 3000; // 3 seconds
-  let totalWaitTime = 0;
+  const firstPollDelay = 500; // a just-created run is never done yet
+  const maxPollInterval = 3000; // 3 seconds
+  let pollInterval = 300; // grows 1.5x after each pending status
+  let totalWaitTime = firstPollDelay;
+
+  await delay(firstPollDelay);
 
   while (totalWaitTime < maxWaitTime) {
     const statusRes = await fetchWithRetry(`https://api.openai.com/v1/threads/${threadId}/runs/${runId}`, {
       method: 'GET',
-      headers: {
-        'Authorization': `Bearer ${openAIApiKey}`,
-        'OpenAI-Beta': 'assistants=v2'
-      }
+      headers: OPENAI_HEADERS_NOBODY
     });
 
     const statusData = await statusRes.json();
@@ -426,8 +831,14 @@ async function processWithAssistant(threadId, fileId, fileName) {
       throw new Error(`Run ${statusData.status}: ${statusData.last_error?.message || "Unknown error"}`);
     }
 
-    await delay(pollInterval);
-    totalWaitTime += pollInterval;
+    // Exponential backoff with ±50% jitter; a server-provided retry-after wins
+    const retryAfter = parseInt(statusRes.headers.get('retry-after'));
+    const waitMs = retryAfter > 0
+      ? retryAfter * 1000
+      : Math.round(pollInterval * (0.5 + Math.random()));
+    await delay(waitMs);
+    totalWaitTime += waitMs;
+    pollInterval = Math.min(pollInterval * 1.5, maxPollInterval);
   }
 
   if (totalWaitTime >= maxWaitTime) {
@@ -437,10 +848,7 @@ async function processWithAssistant(threadId, fileId, fileName) {
   // Get result
   const messagesRes = await fetchWithRetry(`https://api.openai.com/v1/threads/${threadId}/messages`, {
     method: 'GET',
-    headers: {
-      'Authorization': `Bearer ${openAIApiKey}`,
-      'OpenAI-Beta': 'assistants=v2'
-    }
+    headers: OPENAI_HEADERS_NOBODY
   });
 
   const messagesData = await messagesRes.json();
@@ -449,16 +857,40 @@ async function processWithAssistant(threadId, fileId, fileName) {
 
   if (!extractedText) throw new Error("Assistant returned empty response");
 
-  // Parse JSON
-  const jsonMatch = extractedText.match(/```json\n([\s\S]*?)\n```/) || extractedText.match(/\[[\s\S]*\]/);
-  const jsonStr = jsonMatch ? (jsonMatch[1] || jsonMatch[0]) : extractedText;
+  // Parse JSON: the instructions ask for a bare array, so try that first
+  try {
+    const parsed = JSON.parse(extractedText);
+    if (Array.isArray(parsed)) return parsed;
+  } catch {
+    // Fall through to fenced / embedded array extraction
+  }
+
+  // Fenced ```json block, located by index scan rather than a regex
+  let jsonStr = extractedText;
+  const fenceStart = extractedText.indexOf('```json\n');
+  const fenceEnd = fenceStart === -1 ? -1 : extractedText.indexOf('\n```', fenceStart + 8);
+  if (fenceEnd !== -1) {
+    jsonStr = extractedText.slice(fenceStart + 8, fenceEnd);
+  } else {
+    // Outermost [...] by index scan; a greedy regex backtracks badly here
+    const start = extractedText.indexOf('[');
+    const end = extractedText.lastIndexOf(']');
+    if (start !== -1 && end > start) jsonStr = extractedText.slice(start, end + 1);
+  }
   
+  let parsed;
   try {
-    return JSON.parse(jsonStr);
+    parsed = JSON.parse(jsonStr);
   } catch (parseError) {
-    console.error("Failed to parse JSON:", jsonStr);
+    console.error(`Failed to parse JSON (${jsonStr.length} chars):`, DEBUG ? jsonStr : jsonStr.substring(0, 500));
     throw new Error(`Invalid JSON response: ${parseError.message}`);
   }
+  // Callers map over the line items and cache them; anything else is a bad
+  // response to retry, not a result
+  if (!Array.isArray(parsed)) {
+    throw new Error(`Invalid JSON response: expected an array, got ${parsed === null ? 'null' : typeof parsed}`);
+  }
+  return parsed;
 }
 
 async function cleanupResources(fileId, threadId) {
@@ -468,11 +900,11 @@ async function cleanupResources(fileId, threadId) {
     cleanupPromises.push(
       fetchWithRetry(`https://api.openai.com/v1/files/${fileId}`, {
         method: 'DELETE',
-        headers: {
-          'Authorization': `Bearer ${openAIApiKey}`,
-          'OpenAI-Beta': 'assistants=v2'
-        }
-      }).catch(err => console.warn(`File cleanup failed: ${err.message}`))
+        headers: OPENAI_HEADERS_NOBODY
+      })
+        // Drain the body so the connection goes back to the pool
+        .then(res => res.body?.cancel())
+        .catch(err => console.warn(`File cleanup failed: ${err.message}`))
     );
   }
 
@@ -484,28 +916,39 @@ async function cleanupResources(fileId, threadId) {
   await Promise.allSettled(cleanupPromises);
 }
 
+// `options` may be a function returning fresh options per attempt, for
+// requests whose body is a single-use stream
 async function fetchWithRetry(url, options, maxRetries = 3) {
   let lastError;
   
   for (let attempt = 0; attempt < maxRetries; attempt++) {
+    const requestOptions = typeof options === 'function' ? options() : options;
     try {
-      const response = await fetch(url, options);
+      const response = await fetch(url, { ...requestOptions, client: openaiClient });
       
       // Handle rate limiting
       if (response.status === 429) {
         const retryAfter = response.headers.get('retry-after');
         const delayMs = retryAfter ? parseInt(retryAfter) * 1000 : CONFIG.RATE_LIMIT_DELAY * (attempt + 1);
         console.warn(`Rate limited, waiting ${delayMs}ms before retry`);
+        // Unread bodies pin the pooled connection; release it before waiting
+        await response.body?.cancel();
+        lastError = new Error('Rate limited by OpenAI (429)');
+        last429At = Date.now();
+        openaiSlots.pause(delayMs);
         await delay(delayMs);
         continue;
       }
       
       if (!response.ok && response.status >= 500) {
+        await response.body?.cancel();
         throw new Error(`Server error: ${response.status}`);
       }
       
       return response;
     } catch (error) {
+      // Cancelled by the caller; retrying would only be cancelled again
+      if (requestOptions.signal?.aborted) throw error;
       lastError = error;
       if (attempt < maxRetries - 1) {
         const delayMs = CONFIG.INITIAL_DELAY * Math.pow(2, attempt);
@@ -518,51 +961,107 @@ async function fetchWithRetry(url, options, maxRetries = 3) {
   throw lastError;
 }
 
+// Runs a task without blocking the caller. Where the runtime supports it
+// (EdgeRuntime.waitUntil) the worker is kept alive until the task settles.
+function runInBackground(promise) {
+  const task = promise.catch(error => console.warn(`Background task failed: ${error.message}`));
+  globalThis.EdgeRuntime?.waitUntil?.(task);
+}
+
+function debugLog(...args) {
+  if (DEBUG) console.log(...args);
+}
+
 function delay(ms) {
   return new Promise(resolve => setTimeout(resolve, ms));
 }
 
+// Mock data is built per requested field; the date only changes daily so it
+// is computed once per isolate
+const TODAY_ISO = new Date().toISOString().split('T')[0];
+const MOCK_TAX_RATE = 18.00;
+
+function mockTaxableValue(ctx) {
+  ctx.taxableValue ??= Math.round((Math.random() * 50000 + 10000) * 100) / 100;
+  return ctx.taxableValue;
+}
+
+function mockTaxValue(ctx) {
+  ctx.taxValue ??= Math.round(mockTaxableValue(ctx) * MOCK_TAX_RATE / 100 * 100) / 100;
+  return ctx.taxValue;
+}
+
+// Mock fields in output order. Constant values are stored directly; null
+// marks a field that MOCK_GENERATORS computes per call.
+const MOCK_TEMPLATE = Object.freeze({
+  "Document Number": null,
+  "Document Date": TODAY_ISO,
+  "FBA Shipment ID": null,
+  "Purpose of transfer": "Stock Transfer",
+  "Number of box": null,
+  "Supplier Name": "AI Enterprises",
+  "Supplier Address": "1043 K-1 Ward No.8, Mehrauli New Delhi - 110030",
+  "Supplier GSTIN": "07BLZPA4905P1ZF",
+  "Ship To": "Amazon Seller Services Private Limited",
+  "Ship To Address": "ESR Sohna Logistics Park, Village Rahaka, HARYANA",
+  "Ship To GSTIN": "06BLZPA4905P1ZH",
+  "Place of supply": "HARYANA (State/UT Code: 6)",
+  "Place of delivery": "HARYANA (State/UT Code: 6)",
+  "productDescription": null,
+  "quantity": null,
+  "unitValue": null,
+  "hsnSacCode": "8301",
+  "taxableValue": null,
+  "taxRate": MOCK_TAX_RATE,
+  "taxValue": null,
+  "totalValue": null
+});
+
+// `n` is the number taken from the PDF name; `ctx` memoizes values that
+// dependent fields (tax, total) derive from
+const MOCK_GENERATORS = {
+  "Document Number": n => `FBA15K${n}N1JKF`,
+  "FBA Shipment ID": n => `FBA15K${n}N1JKF`,
+  "Number of box": () => Math.floor(Math.random() * 20) + 1,
+  "productDescription": n => `Sample Product ${n}`,
+  "quantity": () => Math.floor(Math.random() * 100) + 1,
+  "unitValue": () => Math.round((Math.random() * 1000 + 100) * 100) / 100,
+  "taxableValue": (n, ctx) => mockTaxableValue(ctx),
+  "taxValue": (n, ctx) => mockTaxValue(ctx),
+  "totalValue": (n, ctx) => mockTaxableValue(ctx) + mockTaxValue(ctx)
+};
+
+// First run of ASCII digits in s, or null; avoids a regex per mock call
+function firstDigits(s) {
+  const n = s.length;
+  let i = 0;
+  while (i < n && (s.charCodeAt(i) < 48 || s.charCodeAt(i) > 57)) i++;
+  let j = i;
+  while (j < n && s.charCodeAt(j) >= 48 && s.charCodeAt(j) <= 57) j++;
+  return i === j ? null : s.slice(i, j);
+}
+
 // Enhanced mock data generator
 function getMockFields({ fieldNames, selectedArea, pdfName = "unknown.pdf" }) {
-  const pdfNumber = pdfName.match(/\d+/)?.[0] || Math.floor(Math.random() * 1000);
-  const useMultipleItems = pdfNumber % 2 === 0;
-
-  const mockData = {
-    "Document Number": `FBA15K${pdfNumber}N1JKF`,
-    "Document Date": new Date().toISOString().split('T')[0],
-    "FBA Shipment ID": `FBA15K${pdfNumber}N1JKF`,
-    "Purpose of transfer": "Stock Transfer",
-    "Number of box": Math.floor(Math.random() * 20) + 1,
-    "Supplier Name": "AI Enterprises",
-    "Supplier Address": "1043 K-1 Ward No.8, Mehrauli New Delhi - 110030",
-    "Supplier GSTIN": "07BLZPA4905P1ZF",
-    "Ship To": "Amazon Seller Services Private Limited",
-    "Ship To Address": "ESR Sohna Logistics Park, Village Rahaka, HARYANA",
-    "Ship To GSTIN": "06BLZPA4905P1ZH",
-    "Place of supply": "HARYANA (State/UT Code: 6)",
-    "Place of delivery": "HARYANA (State/UT Code: 6)",
-    "productDescription": `Sample Product ${pdfNumber}`,
-    "quantity": Math.floor(Math.random() * 100) + 1,
-    "unitValue": Math.round((Math.random() * 1000 + 100) * 100) / 100,
-    "hsnSacCode": "8301",
-    "taxableValue": Math.round((Math.random() * 50000 + 10000) * 100) / 100,
-    "taxRate": 18.00,
-    "taxValue": 0,
-    "totalValue": 0
-  };
+  const pdfNumber = firstDigits(pdfName) || Math.floor(Math.random() * 1000);
+  const ctx = {};
 
-  // Calculate dependent values
-  mockData.taxValue = Math.round(mockData.taxableValue * mockData.taxRate / 100 * 100) / 100;
-  mockData.totalValue = mockData.taxableValue + mockData.taxValue;
-  
   // Return only requested fields if specified
   if (fieldNames?.length > 0) {
     const result = {};
-    fieldNames.forEach(field => {
-      result[field] = mockData[field] || `Sample ${field}`;
-    });
+    for (const field of fieldNames) {
+      const value = Object.hasOwn(MOCK_GENERATORS, field)
+        ? MOCK_GENERATORS[field](pdfNumber, ctx)
+        : Object.hasOwn(MOCK_TEMPLATE, field) && MOCK_TEMPLATE[field];
+      result[field] = value || `Sample ${field}`;
+    }
     return result;
   }
 
+  // Copy the constants, then fill in the computed fields in place
+  const mockData = { ...MOCK_TEMPLATE };
+  for (const field in MOCK_GENERATORS) {
+    mockData[field] = MOCK_GENERATORS[field](pdfNumber, ctx);
+  }
   return mockData;
 }